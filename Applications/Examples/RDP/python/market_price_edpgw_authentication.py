@@ -26,52 +26,194 @@
 """
 
 import sys
-import time
-import getopt
+import argparse
+import dataclasses
+import logging
+import os
 import requests
+import certifi
+from requests.adapters import HTTPAdapter
+import signal
 import socket
+import ssl
+import string
 import json
 import websocket
 import threading
+from typing import Optional
+
+# Use orjson for JSON (de)serialization when it is installed, otherwise the standard json module
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    def json_pretty(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode()
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def json_pretty(obj):
+        return json.dumps(obj, sort_keys=True, indent=2, separators=(',', ':'))
+
+# Sent and received WebSocket messages are logged at DEBUG level, and are only formatted when that level is
+# enabled. Set the LOG_LEVEL environment variable (e.g. LOG_LEVEL=INFO) to turn them off.
+log = logging.getLogger(__name__)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(message)s'))
+log.addHandler(log_handler)
+log_level = (os.environ.get('LOG_LEVEL') or 'DEBUG').upper()
+try:
+    # Accept level names (INFO) as well as numeric levels (20)
+    log.setLevel(int(log_level) if log_level.isdigit() else log_level)
+except ValueError:
+    print("Unknown LOG_LEVEL " + log_level + ", using DEBUG")
+    log.setLevel(logging.DEBUG)
+log.propagate = False
+
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+    """ Command line options, fixed once the example has started """
+    app_id: str = '256'
+    auth_url: str = 'https://api.refinitiv.com:443/auth/oauth2/v1/token'
+    hostname: str = ''
+    password: str = ''
+    newPassword: str = ''
+    position: str = ''
+    user: str = ''
+    clientid: str = ''
+    port: str = '443'
+    client_secret: str = ''
+    scope: str = 'trapi'
+    ric: str = '/TRI.N'
+    service: str = 'ELEKTRON_DD'
+
+
+@dataclasses.dataclass
+class State:
+    """ Authentication and connection state, updated while the example runs """
+    sts_token: str = ''
+    refresh_token: str = ''
+    expire_time: str = '0'
+    original_expire_time: str = '0'
+    web_socket_open: bool = False
+    logged_in: bool = False
+    refresh_timer: Optional[threading.Timer] = None
 
-# Global Default Variables
-app_id = '256'
-auth_url = 'https://api.refinitiv.com:443/auth/oauth2/v1/token'
-hostname = ''
-password = ''
-newPassword = ''
-position = ''
-sts_token = ''
-refresh_token = ''
-user = ''
-clientid = ''
-port = '443'
-client_secret = ''
-scope = 'trapi'
-ric = '/TRI.N'
-service = 'ELEKTRON_DD'
 
 # Global Variables
+config = Config()
+state = State()
 web_socket_app = None
-web_socket_open = False
-logged_in = False
-original_expire_time = '0'; 
+password_auth_data = {}
+refresh_auth_data = {}
+
+# TLS context for the HTTP requests to Refinitiv Data Platform, which carry the credentials and tokens.
+# It verifies both the certificate chain and the hostname.
+http_ssl_context = ssl.create_default_context(cafile=certifi.where())
+http_ssl_context.check_hostname = True
+
+# Separate TLS context for the WebSocket connections, which keep their hostname checking disabled
+ws_ssl_context = ssl.create_default_context(cafile=certifi.where())
+ws_ssl_context.check_hostname = False
+
+
+class SSLContextAdapter(HTTPAdapter):
+    """ HTTPAdapter whose connection pools use the HTTP TLS context """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = http_ssl_context
+        return super(SSLContextAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+# Pooled HTTP session used for all requests to Refinitiv Data Platform, so that
+# token refreshes reuse the established TLS connection instead of reconnecting
+http_session = requests.Session()
+http_session.headers['Accept'] = 'application/json'
+http_session.mount('https://', SSLContextAdapter(pool_connections=2, pool_maxsize=4, max_retries=0))
+
+# Request messages reused for every send; only the variable fields are updated before sending.
+# ApplicationId, Position, Name and Service are filled in once the command line has been parsed.
+login_request_json = {
+    'ID': 1,
+    'Domain': 'Login',
+    'Key': {
+        'NameType': 'AuthnToken',
+        'Elements': {
+            'ApplicationId': '',
+            'Position': '',
+            'AuthenticationToken': ''
+        }
+    }
+}
+market_price_request_json = {
+    'ID': 2,
+    'Key': {
+        'Name': '',
+        'Service': ''
+    },
+}
+
+# The Pong reply never changes, so it is serialized once
+PONG_JSON = {'Type': 'Pong'}
+PONG_MESSAGE = json_dumps(PONG_JSON)
+
+# Messages sent in reply to a received frame. They are only touched from the WebSocket thread, and are
+# sent together once the whole frame has been processed.
+outbound_messages = []
+
+# Limits on the number of messages and characters sent in a single batched WebSocket frame
+MAX_BATCH_MESSAGES = 64
+MAX_BATCH_SIZE = 32 * 1024
+
+# Maximum number of HTTP attempts (including redirects) for a single authentication request
+MAX_RETRIES = 5
+
+# What to do with the response of an authentication request, looked up by HTTP status code.
+# Status codes that are not listed map to AUTH_RETRY.
+AUTH_SUCCEEDED, AUTH_REDIRECT, AUTH_RETRY_WITH_PASSWORD, AUTH_STOP, AUTH_RETRY = range(5)
+AUTH_ACTIONS = {
+    200: AUTH_SUCCEEDED,
+    301: AUTH_REDIRECT,
+    302: AUTH_REDIRECT,
+    307: AUTH_REDIRECT,
+    308: AUTH_REDIRECT,
+    400: AUTH_RETRY_WITH_PASSWORD,
+    401: AUTH_RETRY_WITH_PASSWORD,
+    403: AUTH_STOP,
+    451: AUTH_STOP,
+}
 
 # Global Variables for Password Policy Description
-PASSWORD_LENGTH_MASK                = 0x1;
-PASSWORD_UPPERCASE_LETTER_MASK      = 0x2;
-PASSWORD_LOWERCASE_LETTER_MASK      = 0x4;
-PASSWORD_DIGIT_MASK                 = 0x8;
-PASSWORD_SPECIAL_CHARACTER_MASK     = 0x10;
-PASSWORD_INVALID_CHARACTER_MASK     = 0x20;
-
-PASSWORD_LENGTH_MIN                 = 30;
-PASSWORD_UPPERCASE_LETTER_MIN       = 1;
-PASSWORD_LOWERCASE_LETTER_MIN       = 1;
-PASSWORD_DIGIT_MIN                  = 1;
-PASSWORD_SPECIAL_CHARACTER_MIN      = 1;
-PASSWORD_SPECIAL_CHARACTER_SET      = "~!@#$%^&*()-_=+[]{}|;:,.<>/?";
-PASSWORD_MIN_NUMBER_OF_CATEGORIES   = 3;
+PASSWORD_LENGTH_MASK                = 0x1
+PASSWORD_UPPERCASE_LETTER_MASK      = 0x2
+PASSWORD_LOWERCASE_LETTER_MASK      = 0x4
+PASSWORD_DIGIT_MASK                 = 0x8
+PASSWORD_SPECIAL_CHARACTER_MASK     = 0x10
+PASSWORD_INVALID_CHARACTER_MASK     = 0x20
+
+PASSWORD_LENGTH_MIN                 = 30
+PASSWORD_UPPERCASE_LETTER_MIN       = 1
+PASSWORD_LOWERCASE_LETTER_MIN       = 1
+PASSWORD_DIGIT_MIN                  = 1
+PASSWORD_SPECIAL_CHARACTER_MIN      = 1
+PASSWORD_SPECIAL_CHARACTER_SET      = "~!@#$%^&*()-_=+[]{}|;:,.<>/?"
+PASSWORD_MIN_NUMBER_OF_CATEGORIES   = 3
+
+# Character classes used when checking a new password against the policy
+PASSWORD_UPPERCASE_LETTER_SET       = frozenset(string.ascii_uppercase)
+PASSWORD_LOWERCASE_LETTER_SET       = frozenset(string.ascii_lowercase)
+PASSWORD_DIGIT_SET                  = frozenset(string.digits)
+PASSWORD_SPECIAL_CHARACTER_CHARSET  = frozenset(PASSWORD_SPECIAL_CHARACTER_SET)
+PASSWORD_VALID_CHARACTER_SET        = (PASSWORD_UPPERCASE_LETTER_SET | PASSWORD_LOWERCASE_LETTER_SET |
+                                       PASSWORD_DIGIT_SET | PASSWORD_SPECIAL_CHARACTER_CHARSET)
 
 def process_message(message_json):
     """ Parse at high level and output JSON of message """
@@ -83,36 +225,50 @@ def process_message(message_json):
             if message_domain == "Login":
                 process_login_response(message_json)
     elif message_type == "Ping":
-        pong_json = {'Type': 'Pong'}
-        web_socket_app.send(json.dumps(pong_json))
-        print("SENT:")
-        print(json.dumps(pong_json, sort_keys=True, indent=2, separators=(',', ':')))
+        queue_message(PONG_MESSAGE, PONG_JSON)
 
 
 def process_login_response(message_json):
     """ Send item request """
-    global logged_in
-
     if message_json['State']['Stream'] != "Open" or message_json['State']['Data'] != "Ok":
         print("Login failed.")
         sys.exit(1)
 
-    logged_in = True
-    send_market_price_request(ric)
+    state.logged_in = True
+    send_market_price_request()
 
 
-def send_market_price_request(ric_name):
-    """ Create and send simple Market Price request """
-    mp_req_json = {
-        'ID': 2,
-        'Key': {
-            'Name': ric_name,
-            'Service': service
-        },
-    }
-    web_socket_app.send(json.dumps(mp_req_json))
-    print("SENT:")
-    print(json.dumps(mp_req_json, sort_keys=True, indent=2, separators=(',', ':')))
+def queue_message(message, message_json):
+    """ Queue a serialized message, to be sent along with the other replies to the frame being processed """
+    outbound_messages.append((message, message_json))
+
+
+def flush_messages():
+    """ Send queued messages, batched into as few JSON array frames as the batch limits allow """
+    try:
+        batch = []
+        batch_size = 0
+        for message, _ in outbound_messages:
+            if batch and (len(batch) == MAX_BATCH_MESSAGES or batch_size + len(message) > MAX_BATCH_SIZE):
+                web_socket_app.send('[' + ','.join(batch) + ']')
+                batch = []
+                batch_size = 0
+            batch.append(message)
+            batch_size += len(message) + 1
+        if batch:
+            web_socket_app.send('[' + ','.join(batch) + ']')
+
+        if log.isEnabledFor(logging.DEBUG):
+            for _, message_json in outbound_messages:
+                log.debug("SENT:\n%s", json_pretty(message_json))
+    finally:
+        # Never carry replies over to the next frame, even if sending failed
+        del outbound_messages[:]
+
+
+def send_market_price_request():
+    """ Send simple Market Price request """
+    queue_message(json_dumps(market_price_request_json), market_price_request_json)
 
 
 def send_login_request(auth_token, is_refresh_token):
@@ -120,40 +276,36 @@ def send_login_request(auth_token, is_refresh_token):
         Send login request with authentication token.
         Used both for the initial login and subsequent reissues to update the authentication token
     """
-    login_json = {
-        'ID': 1,
-        'Domain': 'Login',
-        'Key': {
-            'NameType': 'AuthnToken',
-            'Elements': {
-                'ApplicationId': '',
-                'Position': '',
-                'AuthenticationToken': ''
-            }
-        }
-    }
-
-    login_json['Key']['Elements']['ApplicationId'] = app_id
-    login_json['Key']['Elements']['Position'] = position
+    login_json = login_request_json
     login_json['Key']['Elements']['AuthenticationToken'] = auth_token
 
     # If the token is a refresh token, this is not our first login attempt.
     if is_refresh_token:
         login_json['Refresh'] = False
+    else:
+        login_json.pop('Refresh', None)
 
-    web_socket_app.send(json.dumps(login_json))
-    print("SENT:")
-    print(json.dumps(login_json, sort_keys=True, indent=2, separators=(',', ':')))
+    web_socket_app.send(json_dumps(login_json))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("SENT:\n%s", json_pretty(login_json))
 
 
 def on_message(_, message):
     """ Called when message received, parse message into JSON for processing """
-    print("RECEIVED: ")
-    message_json = json.loads(message)
-    print(json.dumps(message_json, sort_keys=True, indent=2, separators=(',', ':')))
+    message_json = json_loads(message)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("RECEIVED:\n%s", json_pretty(message_json))
 
-    for singleMsg in message_json:
-        process_message(singleMsg)
+    # A frame holds either an array of messages or a single message. The replies queued while processing it
+    # are sent even if processing one of the messages fails.
+    try:
+        if type(message_json) is list:
+            for singleMsg in message_json:
+                process_message(singleMsg)
+        else:
+            process_message(message_json)
+    finally:
+        flush_messages()
 
 
 def on_error(_, error):
@@ -163,8 +315,7 @@ def on_error(_, error):
 
 def on_close(_):
     """ Called when websocket is closed """
-    global web_socket_open
-    web_socket_open = False
+    state.web_socket_open = False
     print("WebSocket Closed")
 
 
@@ -172,258 +323,302 @@ def on_open(_):
     """ Called when handshake is complete and websocket is open, send login """
 
     print("WebSocket successfully connected!")
-    global web_socket_open
-    web_socket_open = True
-    send_login_request(sts_token, False)
+    state.web_socket_open = True
+    send_login_request(state.sts_token, False)
+
+
+def compute_position():
+    """ Returns the position (IPv4 address/hostname) of this host, resolved with a single address lookup """
+    try:
+        position_host = socket.gethostname()
+        address_info = socket.getaddrinfo(position_host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        return address_info[0][4][0] + "/" + position_host
+    except socket.gaierror:
+        return "127.0.0.1/net"
 
 
-def get_sts_token(current_refresh_token, url=None):
+def get_sts_token(current_refresh_token):
     """
         Retrieves an authentication token.
         :param current_refresh_token: Refresh token retrieved from a previous authentication, used to retrieve a
         subsequent access token. If not provided (i.e. on the initial authentication), the password is used.
     """
 
-    if url is None:
-        url = auth_url
+    # Options read in the retry loop are bound to locals once
+    auth_url = config.auth_url
+    auth = (config.clientid, config.client_secret)
+    url = auth_url
 
     if not current_refresh_token:  # First time through, send password
-        data = {'username': user, 'password': password, 'client_id': clientid, 'grant_type': 'password', 'takeExclusiveSignOnControl': True,
-                    'scope': scope}
-        print("Sending authentication request with password to", url, "...")
+        data = password_auth_data
     else:  # Use the given refresh token
-        data = {'username': user, 'client_id': clientid, 'refresh_token': current_refresh_token, 'grant_type': 'refresh_token'}
-        print("Sending authentication request with refresh token to", url, "...")
-    if client_secret != '':
-        data['client_secret'] = client_secret;
+        refresh_auth_data['refresh_token'] = current_refresh_token
+        data = refresh_auth_data
 
-    try:
-        # Request with auth for https protocol
-        r = requests.post(url,
-                      headers={'Accept': 'application/json'},
-                      data=data,
-                      auth=(clientid, client_secret),
-                      verify=True,
-                      allow_redirects=False)
-
-    except requests.exceptions.RequestException as e:
-        print('Refinitiv Data Platform authentication exception failure:', e)
-        return None, None, None
-
-    if r.status_code == 200:
-        auth_json = r.json()
-        print("Refinitiv Data Platform Authentication succeeded. RECEIVED:")
-        print(json.dumps(auth_json, sort_keys=True, indent=2, separators=(',', ':')))
-
-        return auth_json['access_token'], auth_json['refresh_token'], auth_json['expires_in']
-    elif r.status_code == 301 or r.status_code == 302 or r.status_code == 307 or r.status_code == 308:
-        # Perform URL redirect
-        print('Refinitiv Data Platform authentication HTTP code:', r.status_code, r.reason)
-        new_host = r.headers['Location']
-        if new_host is not None:
+    for _ in range(MAX_RETRIES):
+        if not current_refresh_token:
+            print("Sending authentication request with password to", url, "...")
+        else:
+            print("Sending authentication request with refresh token to", url, "...")
+
+        try:
+            # Request with auth for https protocol
+            r = http_session.post(url,
+                                  data=data,
+                                  auth=auth,
+                                  verify=True,
+                                  allow_redirects=False)
+
+        except requests.exceptions.RequestException as e:
+            print('Refinitiv Data Platform authentication exception failure:', e)
+            return None, None, None
+
+        action = AUTH_ACTIONS.get(r.status_code, AUTH_RETRY)
+        if action == AUTH_SUCCEEDED:
+            auth_json = r.json()
+            print("Refinitiv Data Platform Authentication succeeded. RECEIVED:")
+            print(json_pretty(auth_json))
+
+            return auth_json['access_token'], auth_json['refresh_token'], auth_json['expires_in']
+        elif action == AUTH_REDIRECT:
+            # Perform URL redirect
+            print('Refinitiv Data Platform authentication HTTP code:', r.status_code, r.reason)
+            new_host = r.headers.get('Location')
+            if new_host is None:
+                return None, None, None
             print('Perform URL redirect to ', new_host)
-            return get_sts_token(current_refresh_token, new_host)
-        return None, None, None
-    elif r.status_code == 400 or r.status_code == 401:
-        # Retry with username and password
-        print('Refinitiv Data Platform authentication HTTP code:', r.status_code, r.reason)
-        if current_refresh_token:
+            url = new_host
+        elif action == AUTH_RETRY_WITH_PASSWORD:
+            # Retry with username and password
+            print('Refinitiv Data Platform authentication HTTP code:', r.status_code, r.reason)
+            if not current_refresh_token:
+                return None, None, None
             # Refresh token may have expired. Try using our password.
             print('Retry with username and password')
-            return get_sts_token(None)
-        return None, None, None
-    elif r.status_code == 403 or r.status_code == 451:
-        # Stop retrying with the request
-        print('Refinitiv Data Platform authentication HTTP code:', r.status_code, r.reason)
-        print('Stop retrying with the request')
-        return None, None, None
-    else:
-        # Retry the request to Refinitiv Data Platform 
-        print('Refinitiv Data Platform authentication HTTP code:', r.status_code, r.reason)
-        print('Retry the request to the Refinitiv Data Platform')
-        return get_sts_token(current_refresh_token)
+            current_refresh_token = None
+            data = password_auth_data
+            url = auth_url
+        elif action == AUTH_STOP:
+            # Stop retrying with the request
+            print('Refinitiv Data Platform authentication HTTP code:', r.status_code, r.reason)
+            print('Stop retrying with the request')
+            return None, None, None
+        else:
+            # Retry the request to Refinitiv Data Platform
+            print('Refinitiv Data Platform authentication HTTP code:', r.status_code, r.reason)
+            print('Retry the request to the Refinitiv Data Platform')
+            url = auth_url
+
+    print('Stop retrying after', MAX_RETRIES, 'attempts')
+    return None, None, None
+
+
+def schedule_token_refresh():
+    """ Continue using current token until 90% of initial time before it expires, then refresh it """
+    state.refresh_timer = threading.Timer(int(float(state.expire_time) * 0.90), refresh_sts_token)
+    state.refresh_timer.daemon = True
+    state.refresh_timer.start()
+
+
+def refresh_sts_token():
+    """
+        Called by the refresh timer. Re-authenticates to Refinitiv Data Platform, provides the updated token
+        to the Real-Time endpoint and schedules the next refresh.
+    """
+    try:
+        # Work on locals and store the result in the shared state once
+        sts_token, refresh_token, expire_time = get_sts_token(state.refresh_token)
+        original_expire_time = state.original_expire_time
+        if sts_token and int(expire_time) != int(original_expire_time):
+            print('expire time changed from ' + str(original_expire_time) + ' sec to ' + str(expire_time) +
+                  ' sec; retry with password')
+            sts_token, refresh_token, expire_time = get_sts_token(None)
+            if sts_token:
+                state.original_expire_time = expire_time
+        state.sts_token, state.refresh_token, state.expire_time = sts_token, refresh_token, expire_time
+
+        if sts_token:
+            # Update token.
+            if state.logged_in:
+                send_login_request(sts_token, True)
+
+            schedule_token_refresh()
+            return
+    except Exception as e:
+        # An exception would otherwise only end the timer thread, leaving the connection up without a valid token
+        print('Refinitiv Data Platform token refresh failure:', e)
+        state.sts_token = None
+
+    # Closing the WebSocket ends the event loop in the main thread, which then exits
+    web_socket_app.close()
+
+
+def has_minimum_count(pwd, chars, char_set, minimum):
+    """ Returns whether pwd holds at least minimum characters of char_set, stopping as soon as it does """
+    count = 0
+    for c in chars & char_set:
+        count += pwd.count(c)
+        if count >= minimum:
+            return True
+    return minimum <= 0
+
 
 def check_new_password(pwd):
-    result = 0;
+    result = 0
 
-    countUpper = 0;
-    countLower = 0;
-    countDigit = 0;
-    countSpecial = 0;
+    if len(pwd) < PASSWORD_LENGTH_MIN:
+        result |= PASSWORD_LENGTH_MASK
+
+    # Classify the distinct characters with set operations. Each class stops counting once its minimum is met.
+    chars = set(pwd)
+    if not chars <= PASSWORD_VALID_CHARACTER_SET:
+        result |= PASSWORD_INVALID_CHARACTER_MASK
+
+    if not has_minimum_count(pwd, chars, PASSWORD_UPPERCASE_LETTER_SET, PASSWORD_UPPERCASE_LETTER_MIN):
+        result |= PASSWORD_UPPERCASE_LETTER_MASK
+    if not has_minimum_count(pwd, chars, PASSWORD_LOWERCASE_LETTER_SET, PASSWORD_LOWERCASE_LETTER_MIN):
+        result |= PASSWORD_LOWERCASE_LETTER_MASK
+    if not has_minimum_count(pwd, chars, PASSWORD_DIGIT_SET, PASSWORD_DIGIT_MIN):
+        result |= PASSWORD_DIGIT_MASK
+    if not has_minimum_count(pwd, chars, PASSWORD_SPECIAL_CHARACTER_CHARSET, PASSWORD_SPECIAL_CHARACTER_MIN):
+        result |= PASSWORD_SPECIAL_CHARACTER_MASK
 
-    if len(pwd) < PASSWORD_LENGTH_MIN :
-        result |= PASSWORD_LENGTH_MASK;
-    
-    for c in pwd :
-        # This long condition is used in order not to import re library
-        # If re will be imported for some other purpose this condition should be
-        # refactored using regular expression
-        if not ((c >= 'A' and c <= 'Z') or (c >= 'a' and c <= 'z') \
-              or (c >= '0' and c <= '9') or (c in  PASSWORD_SPECIAL_CHARACTER_SET)) :
-            result |= PASSWORD_INVALID_CHARACTER_MASK;
-        
-        if (c >= 'A' and c <= 'Z') :
-           countUpper += 1;
-        if (c >= 'a' and c <= 'z') :
-           countLower += 1;
-        if (c >= '0' and c <= '9') :
-            countDigit += 1;
-        if (c in  PASSWORD_SPECIAL_CHARACTER_SET) :
-            countSpecial += 1;
-
-    if (countUpper < PASSWORD_UPPERCASE_LETTER_MIN) :        
-        result |= PASSWORD_UPPERCASE_LETTER_MASK;
-    if (countLower < PASSWORD_LOWERCASE_LETTER_MIN) : 
-        result |= PASSWORD_LOWERCASE_LETTER_MASK;
-    if (countDigit < PASSWORD_DIGIT_MIN) :
-        result |= PASSWORD_DIGIT_MASK;       
-    if (countSpecial < PASSWORD_SPECIAL_CHARACTER_MIN) :        
-        result |= PASSWORD_SPECIAL_CHARACTER_MASK;
-           
     return result
  
  
 def changePassword():
 
-    data = {'username': user, 'password': password, 'client_id': clientid, 'grant_type': 'password', 'takeExclusiveSignOnControl': True,
-                    'scope': scope, 'newPassword' : newPassword}
-    print("Sending changing password request to", auth_url, "...")
+    data = {'username': config.user, 'password': config.password, 'client_id': config.clientid, 'grant_type': 'password',
+            'takeExclusiveSignOnControl': True, 'scope': config.scope, 'newPassword': config.newPassword}
+    url = config.auth_url
 
-    try:
-        # Request with auth for https protocol
-        r = requests.post(auth_url,
-                          headers={'Accept': 'application/json'},
-                          data=data,
-                          auth=(clientid, client_secret),
-                          verify=True,
-                          allow_redirects=False)
-
-    except requests.exceptions.RequestException as e:
-        print('Changing password exception failure:', e)
-        return False
-
-    if r.status_code == 200:
-        auth_json = r.json()
-        print("Password successfully changed.")
-        print(json.dumps(auth_json, sort_keys=True, indent=2, separators=(',', ':')))
-        return True
-    elif r.status_code == 301 or r.status_code == 302 or r.status_code == 307 or r.status_code == 308:
-        # Perform URL redirect
-        print('Changing password response HTTP code:', r.status_code, r.reason)
-        new_host = r.headers['Location']
-        if new_host is not None:
+    for _ in range(MAX_RETRIES):
+        print("Sending changing password request to", url, "...")
+
+        try:
+            # Request with auth for https protocol
+            r = http_session.post(url,
+                                  data=data,
+                                  auth=(config.clientid, config.client_secret),
+                                  verify=True,
+                                  allow_redirects=False)
+
+        except requests.exceptions.RequestException as e:
+            print('Changing password exception failure:', e)
+            return False
+
+        # Changing the password has no fallback request, so any other error status stops like AUTH_STOP
+        action = AUTH_ACTIONS.get(r.status_code, AUTH_STOP if r.status_code >= 400 else AUTH_RETRY)
+        if action == AUTH_SUCCEEDED:
+            auth_json = r.json()
+            print("Password successfully changed.")
+            print(json_pretty(auth_json))
+            return True
+        elif action == AUTH_REDIRECT:
+            # Perform URL redirect
+            print('Changing password response HTTP code:', r.status_code, r.reason)
+            new_host = r.headers.get('Location')
+            if new_host is None:
+                return False
             print('Perform URL redirect to ', new_host)
-            return changePassword()
-        return False
-    elif r.status_code >= 400 :
-        # Error during change password attempt
-        auth_json = r.json()
-        print('Changing password response HTTP code:', r.status_code, r.reason)
-        print(json.dumps(auth_json, sort_keys=True, indent=2, separators=(',', ':')))
-        return False
-    else:
-        # Retry the request to the API gateway
-        print('Changing password response HTTP code:', r.status_code, r.reason)
-        print('Retry change request')
-        return changePassword()
-    
-    
-    
+            url = new_host
+        elif action == AUTH_RETRY_WITH_PASSWORD or action == AUTH_STOP:
+            # Error during change password attempt
+            auth_json = r.json()
+            print('Changing password response HTTP code:', r.status_code, r.reason)
+            print(json_pretty(auth_json))
+            return False
+        else:
+            # Retry the request to the API gateway
+            print('Changing password response HTTP code:', r.status_code, r.reason)
+            print('Retry change request')
+            url = config.auth_url
+
+    print('Stop retrying after', MAX_RETRIES, 'attempts')
+    return False
+
 
 if __name__ == "__main__":
     # Get command line parameters
-    try:
-        opts, args = getopt.getopt(sys.argv[1:], "", ["help", "hostname=", "port=", "app_id=", "user=", "clientid=", "password=",
-                                                      "newPassword=", "position=", "auth_url=", "scope=", "ric=", "service="])
-    except getopt.GetoptError:
-        print('Usage: market_price_edpgw_authentication.py [--hostname hostname] [--port port] [--app_id app_id] '
-              '[--user user] [--clientid clientid] [--password password] [--newPassword new_password] [--position position] [--auth_url auth_url] '
-              '[--scope scope] [--ric ric] [--service service] [--help]')
-        sys.exit(2)
-    for opt, arg in opts:
-        if opt in "--help":
-            print('Usage: market_price_edpgw_authentication.py [--hostname hostname] [--port port] [--app_id app_id] '
-                  '[--user user] [--clientid clientid] [--password password] [--newPassword new_password] [--position position] [--auth_url auth_url] '
-                  '[--scope scope] [--ric ric] [--service service] [--help]')
-            sys.exit(0)
-        elif opt in "--hostname":
-            hostname = arg
-        elif opt in "--port":
-            port = arg
-        elif opt in "--app_id":
-            app_id = arg
-        elif opt in "--user":
-            user = arg
-        elif opt in "--clientid":
-            clientid = arg
-        elif opt in "--password":
-            password = arg
-        elif opt in "--newPassword":
-            newPassword = arg
-        elif opt in "--position":
-            position = arg
-        elif opt in "--auth_url":
-            auth_url = arg
-        elif opt in "--scope":
-            scope = arg
-        elif opt in "--ric":
-            ric = arg
-        elif opt in "--service":
-            service = arg
-
-    if user == '' or password == '' or  hostname == '' or clientid == '':
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--hostname', default=Config.hostname)
+    parser.add_argument('--port', default=Config.port)
+    parser.add_argument('--app_id', default=Config.app_id)
+    parser.add_argument('--user', default=Config.user)
+    parser.add_argument('--clientid', default=Config.clientid)
+    parser.add_argument('--password', default=Config.password)
+    parser.add_argument('--newPassword', default=Config.newPassword)
+    parser.add_argument('--position', default=Config.position)
+    parser.add_argument('--auth_url', default=Config.auth_url)
+    parser.add_argument('--scope', default=Config.scope)
+    parser.add_argument('--ric', default=Config.ric)
+    parser.add_argument('--service', default=Config.service)
+    args = parser.parse_args()
+    config = Config(**vars(args))
+
+    if config.user == '' or config.password == '' or config.hostname == '' or config.clientid == '':
         print("user, clientid, password, and hostname are required options")
         sys.exit(2)
        
-    if (newPassword != '') :
-        policyResult = check_new_password(newPassword);
+    if config.newPassword != '':
+        policyResult = check_new_password(config.newPassword)
+
+        if policyResult & PASSWORD_INVALID_CHARACTER_MASK:
+            print("New password contains invalid symbol")
+            print("valid symbols are [A-Z][a-z][0-9]", PASSWORD_SPECIAL_CHARACTER_SET, sep='')
+            sys.exit(2)
+
+        if policyResult & PASSWORD_LENGTH_MASK:
+            print("New password length should be at least ", PASSWORD_LENGTH_MIN, " characters")
+            sys.exit(2)
+
+        countCategories = 0
+        if not policyResult & PASSWORD_UPPERCASE_LETTER_MASK:
+            countCategories += 1
+        if not policyResult & PASSWORD_LOWERCASE_LETTER_MASK:
+            countCategories += 1
+        if not policyResult & PASSWORD_DIGIT_MASK:
+            countCategories += 1
+        if not policyResult & PASSWORD_SPECIAL_CHARACTER_MASK:
+            countCategories += 1
+
+        if countCategories < PASSWORD_MIN_NUMBER_OF_CATEGORIES:
+            print("Password must contain characters belonging to at least three of the following four categories:\n"
+                  "uppercase letters, lowercase letters, digits, and special characters.\n")
+            sys.exit(2)
+
+        if not changePassword():
+            sys.exit(2)
+
+        config = dataclasses.replace(config, password=config.newPassword, newPassword='')
     
-        if (policyResult & PASSWORD_INVALID_CHARACTER_MASK != 0) :
-            print("New password contains invalid symbol");
-            print("valid symbols are [A-Z][a-z][0-9]", PASSWORD_SPECIAL_CHARACTER_SET, sep = '');       
-            sys.exit(2);
-        
-        if (policyResult & PASSWORD_LENGTH_MASK != 0) :
-            print("New password length should be at least ", PASSWORD_LENGTH_MIN, " characters"); 
-            sys.exit(2);
-        
-        countCategories = 0;
-        if (policyResult & PASSWORD_UPPERCASE_LETTER_MASK == 0) :
-            countCategories += 1;
-        if (policyResult & PASSWORD_LOWERCASE_LETTER_MASK == 0) :
-            countCategories += 1;
-        if (policyResult & PASSWORD_DIGIT_MASK == 0) :
-            countCategories += 1;
-        if (policyResult & PASSWORD_SPECIAL_CHARACTER_MASK == 0) :
-            countCategories += 1;        
-    
-        if (countCategories < PASSWORD_MIN_NUMBER_OF_CATEGORIES) :    
-            print ("Password must contain characters belonging to at least three of the following four categories:\n"
-		    	 "uppercase letters, lowercase letters, digits, and special characters.\n");
-            sys.exit(2);     
-    
-        if (not changePassword()):
-            sys.exit(2); 
-            
-        password = newPassword;
-        newPassword = '';
-    
-    if position == '':
+    if config.position == '':
         # Populate position if possible
-        try:
-            position_host = socket.gethostname()
-            position = socket.gethostbyname(position_host) + "/" + position_host
-        except socket.gaierror:
-            position = "127.0.0.1/net"
-
-    sts_token, refresh_token, expire_time = get_sts_token(None)
-    if not sts_token:
+        config = dataclasses.replace(config, position=compute_position())
+
+    # The application ID, position, item name and service do not change, so they are stored in the requests once
+    login_request_json['Key']['Elements']['ApplicationId'] = config.app_id
+    login_request_json['Key']['Elements']['Position'] = config.position
+    market_price_request_json['Key']['Name'] = config.ric
+    market_price_request_json['Key']['Service'] = config.service
+
+    # Authentication request bodies; only the refresh token changes between requests
+    password_auth_data = {'username': config.user, 'password': config.password, 'client_id': config.clientid,
+                          'grant_type': 'password', 'takeExclusiveSignOnControl': True, 'scope': config.scope}
+    refresh_auth_data = {'username': config.user, 'client_id': config.clientid, 'refresh_token': '',
+                         'grant_type': 'refresh_token'}
+    if config.client_secret != '':
+        password_auth_data['client_secret'] = config.client_secret
+        refresh_auth_data['client_secret'] = config.client_secret
+
+    state.sts_token, state.refresh_token, state.expire_time = get_sts_token(None)
+    if not state.sts_token:
         sys.exit(1)
 
-    original_expire_time = expire_time
+    state.original_expire_time = state.expire_time
 
     # Start websocket handshake
-    ws_address = "wss://{}:{}/WebSocket".format(hostname, port)
+    ws_address = "wss://{}:{}/WebSocket".format(config.hostname, config.port)
     print("Connecting to WebSocket " + ws_address + " ...")
     web_socket_app = websocket.WebSocketApp(ws_address, on_message=on_message,
                                             on_error=on_error,
@@ -431,28 +626,20 @@ if __name__ == "__main__":
                                             subprotocols=['tr_json2'])
     web_socket_app.on_open = on_open
 
-    # Event loop
-    wst = threading.Thread(target=web_socket_app.run_forever, kwargs={'sslopt': {'check_hostname': False}})
-    wst.start()
+    # Refresh the token from a timer while the WebSocket event loop runs in the main thread
+    schedule_token_refresh()
 
-    try:
-        while True:
-            #  Continue using current token until 90% of initial time before it expires.
-            time.sleep(int(float(expire_time) * 0.90))
+    # Handle SIGTERM like Ctrl-C, which interrupts the event loop and closes the WebSocket
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
-            sts_token, refresh_token, expire_time = get_sts_token(refresh_token)
-            if not sts_token:
-                sys.exit(1)
- 
-            if int(expire_time) != int(original_expire_time):
-               print('expire time changed from ' + str(original_expire_time) + ' sec to ' + str(expire_time) + ' sec; retry with password')
-               sts_token, refresh_token, expire_time = get_sts_token(None)
-               if not sts_token:
-                   sys.exit(1) 
-               original_expire_time = expire_time 
-
-            # Update token.
-            if logged_in:
-                send_login_request(sts_token, True)
+    # Received frames are parsed as JSON, which rejects invalid text, so websocket-client's own
+    # (pure Python) UTF-8 validation of every frame is skipped
+    try:
+        web_socket_app.run_forever(sslopt={'context': ws_ssl_context, 'check_hostname': False},
+                                   skip_utf8_validation=True)
     except KeyboardInterrupt:
         web_socket_app.close()
+
+    state.refresh_timer.cancel()
+    if not state.sts_token:
+        sys.exit(1)